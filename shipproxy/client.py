@@ -1,14 +1,42 @@
 import argparse
+import collections
 import io
+import logging
 import queue
 import socket
 import threading
 import time
 from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
-from typing import Dict, List, Optional, Tuple
+from typing import Callable, Dict, Iterator, List, Optional, Tuple, Union
 
 from . import proto
-from .httpx import copy_headers
+from .httpx import copy_headers, iter_chunked
+
+log = logging.getLogger(__name__)
+
+# HTTP requests allowed on the link before their responses come back. The
+# offshore server still executes them one by one, in order.
+MAX_INFLIGHT = 8
+# Response frames buffered per job before the link reader waits on the
+# browser to catch up.
+RESPONSE_BACKLOG = 64
+# Pseudo frame type delivered to a job whose link failed under it
+_JobFailed = -1
+# Request body chunks buffered per job. Bodies that fit are read in full on
+# the handler thread before the job joins the link queue; larger uploads
+# stream through this backlog.
+BODY_BACKLOG = 16
+# Seconds the link writer waits for the next chunk of a streaming upload
+# before aborting it; every request behind it waits too.
+BODY_STALL = 10
+# Queued in place of the next body chunk when the upload was cut short
+_BodyAborted = object()
+# Seconds of link silence before a heartbeat frame is sent, keeping NAT and
+# firewall idle timers from dropping the connection
+HEARTBEAT_INTERVAL = 20
+# Body frames smaller than this are flushed to the browser right away: they
+# usually mark an event or stream boundary rather than bulk transfer.
+SMALL_FLUSH = 4 * 1024
 
 
 class SingleLink:
@@ -28,10 +56,14 @@ class SingleLink:
             for i in range(5):
                 try:
                     sock = socket.create_connection((self.server_host, self.server_port), timeout=10)
-                    sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+                    # The timeout only bounds connecting. Responses may take
+                    # longer than that, and tunnel splicing needs a blocking fd.
+                    sock.settimeout(None)
+                    proto.enable_keepalive(sock)
+                    proto.tune_socket(sock)
                     self.sock = sock
-                    self.r = sock.makefile("rb")
-                    self.w = sock.makefile("wb")
+                    self.r = sock.makefile("rb", buffering=proto.LINK_BUF)
+                    self.w = sock.makefile("wb", buffering=proto.LINK_BUF)
                     return
                 except Exception as e:
                     last_err = e
@@ -39,18 +71,31 @@ class SingleLink:
             raise RuntimeError(f"connect offshore failed: {last_err}")
 
     def reset(self) -> None:
+        # Never raises: callers use it from error paths on the worker and
+        # reader threads. The socket goes first so a thread blocked reading
+        # the link wakes up; closing the writer afterwards may try to flush
+        # frames onto the dead socket, which is ignored.
         with self._lock:
-            try:
-                if self.r:
-                    self.r.close()
-                if self.w:
-                    self.w.close()
-                if self.sock:
-                    self.sock.close()
-            finally:
-                self.sock = None
-                self.r = None
-                self.w = None
+            sock, r, w = self.sock, self.r, self.w
+            self.sock = None
+            self.r = None
+            self.w = None
+            if sock is not None:
+                try:
+                    sock.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+                try:
+                    sock.close()
+                except OSError:
+                    pass
+            for f in (r, w):
+                if f is None:
+                    continue
+                try:
+                    f.close()
+                except (OSError, ValueError):
+                    pass
 
 
 class RequestJob:
@@ -58,33 +103,80 @@ class RequestJob:
         self.handler = handler
         self.method = handler.command
         self.path = handler.path
-        # Convert headers to dict[str, list[str]]
+        # Convert headers to dict[str, list[str]] in one pass over the
+        # parsed header list (get_all per name rescans it every time)
         hdr: Dict[str, List[str]] = {}
-        for k in handler.headers.keys():
-            vv = handler.headers.get_all(k) or []
-            hdr[k] = vv
+        hdr_get = hdr.get
+        for k, v in handler.headers.items():
+            vals = hdr_get(k)
+            if vals is None:
+                hdr[k] = [v]
+            else:
+                vals.append(v)
         self.headers = hdr
-        self.body: bytes = b""
+        # The handler thread reads the body from the browser into `body`
+        # (None ends it); the link writer forwards it frame by frame.
+        self.rfile = handler.rfile
+        self.content_length: Optional[int] = None
+        self.chunked = False
         if self.method not in ("GET", "HEAD", "CONNECT"):
-            # Read fixed-length body if provided
-            clen = handler.headers.get("Content-Length")
-            if clen:
-                try:
-                    n = int(clen)
-                    if n > 0:
-                        self.body = handler.rfile.read(n)
-                except Exception:
-                    self.body = handler.rfile.read(0)
-        self._done = threading.Event()
+            if "chunked" in handler.headers.get("Transfer-Encoding", "").lower():
+                self.chunked = True
+            else:
+                clen = handler.headers.get("Content-Length")
+                if clen:
+                    try:
+                        n = int(clen)
+                        if n > 0:
+                            self.content_length = n
+                    except Exception:
+                        pass
+        self.body: "queue.Queue[object]" = queue.Queue(maxsize=BODY_BACKLOG)
+        self.body_abandoned = False
+        # Response frames routed here by the link reader
+        self.frames: "queue.Queue[Tuple[int, bytes]]" = queue.Queue(maxsize=RESPONSE_BACKLOG)
         self.error: Optional[Exception] = None
+        self._complete = False
+
+    def read_body(self) -> Iterator[bytes]:
+        if self.chunked:
+            yield from iter_chunked(self.rfile, proto.CHUNK)
+        elif self.content_length:
+            remaining = self.content_length
+            while remaining:
+                chunk = self.rfile.read(min(proto.CHUNK, remaining))
+                if not chunk:
+                    raise EOFError("browser closed before sending the full body")
+                yield chunk
+                remaining -= len(chunk)
+
+    def put_body(self, item: object) -> bool:
+        # False once the link writer will not take any more of the body
+        while self.error is None and not self.body_abandoned:
+            try:
+                self.body.put(item, timeout=1)
+                return True
+            except queue.Full:
+                pass
+        return False
 
-    def wait(self) -> Optional[Exception]:
-        self._done.wait()
-        return self.error
+    def deliver(self, t: int, payload: bytes) -> None:
+        self.frames.put((t, payload))
 
-    def finish(self, err: Optional[Exception]) -> None:
+    def fail(self, err: Exception) -> None:
         self.error = err
-        self._done.set()
+        self.frames.put((_JobFailed, b""))
+
+    def next_frame(self) -> Tuple[int, bytes]:
+        t, payload = self.frames.get()
+        if t in (proto.TypeResponseEnd, _JobFailed):
+            self._complete = True
+        return t, payload
+
+    def drain(self) -> None:
+        # Keep the link reader from blocking on a response nobody will write
+        while not self._complete:
+            self.next_frame()
 
 
 class ConnectJob:
@@ -103,33 +195,200 @@ class ConnectJob:
         self._done.set()
 
 
+class HeartbeatJob:
+    # Rides the in-flight window like a request; the reader consumes the echo
+    def __init__(self):
+        self.error: Optional[Exception] = None
+
+    def fail(self, err: Exception) -> None:
+        self.error = err
+
+
 class ProxyApp:
     def __init__(self, server_addr: Tuple[str, int]):
         self.link = SingleLink(*server_addr)
-        self.queue: "queue.Queue[object]" = queue.Queue(maxsize=128)
+        # Jobs waiting for the link writer. A bare deque with its own
+        # condition is lighter than queue.Queue; the semaphore keeps the old
+        # bound of 128 queued jobs.
+        self._jobs: "collections.deque[object]" = collections.deque()
+        self._jobs_cv = threading.Condition()
+        self._job_slots = threading.Semaphore(128)
+        # HTTP jobs whose requests are on the link, oldest first. Responses
+        # come back in the same order.
+        self._inflight: "collections.deque[Union[RequestJob, HeartbeatJob]]" = collections.deque()
+        self._cv = threading.Condition()
+        # Writer state read by the heartbeat thread
+        self._busy = False
+        self._last_active = time.monotonic()
         self.worker_th = threading.Thread(target=self._worker, daemon=True)
         self.worker_th.start()
+        self.reader_th = threading.Thread(target=self._reader, daemon=True)
+        self.reader_th.start()
+        self.heartbeat_th = threading.Thread(target=self._heartbeat, daemon=True)
+        self.heartbeat_th.start()
+
+    def submit(self, job: RequestJob) -> None:
+        # Runs on the handler thread, so a slow uploader only holds up its
+        # own connection. The job joins the link queue once its body is
+        # complete, or as soon as the body backlog fills and it must stream.
+        queued = False
+
+        def put(item: object) -> bool:
+            nonlocal queued
+            if not queued and job.body.full():
+                self.enqueue(job)
+                queued = True
+            return job.put_body(item)
+
+        complete = False
+        try:
+            for chunk in job.read_body():
+                if not put(chunk):
+                    break
+            else:
+                complete = True
+        except Exception as e:
+            log.debug("Reading request body for %s failed: %s", job.path, e)
+        if not complete:
+            # Whatever is left of the body is still on the browser
+            # connection, so it can't carry another request
+            job.handler.close_connection = True
+        put(None if complete else _BodyAborted)
+        if not queued:
+            self.enqueue(job)
 
     def enqueue(self, job):
-        self.queue.put(job)
+        self._job_slots.acquire()
+        with self._jobs_cv:
+            self._jobs.append(job)
+            self._jobs_cv.notify()
+
+    def _next_job(self):
+        with self._jobs_cv:
+            while not self._jobs:
+                self._jobs_cv.wait()
+            job = self._jobs.popleft()
+        self._job_slots.release()
+        return job
+
+    def _wait_idle(self):
+        with self._cv:
+            while self._inflight:
+                self._cv.wait()
 
     def _worker(self):
+        # Writer side of the link: sends requests without waiting for their
+        # responses. CONNECT tunnels need the link to themselves, so they
+        # wait for the in-flight window to drain first.
         while True:
-            job = self.queue.get()
+            job = self._next_job()
+            self._busy = True
             try:
                 if isinstance(job, RequestJob):
-                    self._process_http(job)
+                    self._send_inflight(job, self._process_http)
+                elif isinstance(job, HeartbeatJob):
+                    self._send_inflight(job, self._process_heartbeat)
                 elif isinstance(job, ConnectJob):
-                    self._process_connect(job)
+                    self._wait_idle()
+                    try:
+                        self._process_connect(job)
+                        job.finish(None)
+                    except Exception as e:
+                        job.finish(e)
                 else:
-                    raise RuntimeError("unknown job type")
-                job.finish(None)
+                    log.error("Dropping unknown job type %r", type(job).__name__)
+            except Exception:
+                # Nothing may take the only writer thread down with it
+                log.exception("Link worker failed handling %s", type(job).__name__)
+            finally:
+                self._last_active = time.monotonic()
+                self._busy = False
+
+    def _heartbeat(self):
+        # Queue a heartbeat only when the link is up and nothing else is
+        # using it; any traffic already resets the idle timers.
+        while True:
+            time.sleep(HEARTBEAT_INTERVAL)
+            if self.link.sock is None or self._busy:
+                continue
+            if time.monotonic() - self._last_active < HEARTBEAT_INTERVAL:
+                continue
+            with self._cv:
+                idle = not self._inflight
+            with self._jobs_cv:
+                idle = idle and not self._jobs
+            if idle:
+                self.enqueue(HeartbeatJob())
+
+    def _reader(self):
+        # Reader side of the link: routes response frames to the oldest
+        # in-flight job.
+        while True:
+            with self._cv:
+                while not self._inflight:
+                    self._cv.wait()
+                job = self._inflight[0]
+                r = self.link.r
+            try:
+                self._read_response(r, job)
             except Exception as e:
-                job.finish(e)
+                with self._cv:
+                    try:
+                        self.link.reset()
+                    except Exception:
+                        log.exception("Resetting the link failed")
+                    for j in self._inflight:
+                        j.fail(e)
+                    self._inflight.clear()
+                    self._cv.notify_all()
+                continue
+            with self._cv:
+                self._inflight.popleft()
+                self._cv.notify_all()
+
+    def _read_response(self, r: Optional[io.BufferedReader], job: Union[RequestJob, HeartbeatJob]):
+        assert r
+        t, payload = proto.read_frame(r)
+        if isinstance(job, HeartbeatJob):
+            if t != proto.TypeHeartbeat:
+                raise RuntimeError(f"unexpected frame waiting heartbeat: {t}")
+            return
+        if t != proto.TypeResponseStart:
+            raise RuntimeError(f"unexpected frame waiting response start: {t}")
+        job.deliver(t, payload)
+        while True:
+            t, payload = proto.read_frame(r)
+            if t == proto.TypeResponseBodyChunk:
+                job.deliver(t, payload)
+            elif t == proto.TypeResponseEnd:
+                job.deliver(t, payload)
+                return
+            else:
+                raise RuntimeError(f"unexpected frame in response: {t}")
+
+    def _send_inflight(self, job: Union[RequestJob, HeartbeatJob], send: Callable):
+        with self._cv:
+            while len(self._inflight) >= MAX_INFLIGHT:
+                self._cv.wait()
+        try:
+            self.link.ensure()
+        except Exception as e:
+            job.fail(e)
+            return
+        with self._cv:
+            self._inflight.append(job)
+            self._cv.notify_all()
+        try:
+            send(job)
+        except Exception:
+            # The job is already in flight, so the reader fails it along
+            # with everything behind it once the link goes down.
+            self.link.reset()
+            self._wait_idle()
 
     def _process_http(self, job: RequestJob):
-        self.link.ensure()
-        assert self.link.r and self.link.w
+        w = self.link.w
+        assert w
 
         # Prepare headers dictionary and strip hop-by-hop ones
         hdr: Dict[str, List[str]] = {}
@@ -141,51 +400,76 @@ class ProxyApp:
             abs_url = f"http://{job.handler.headers.get('Host')}{job.path}"
 
         # Send request start
-        proto.write_json_frame(self.link.w, proto.TypeRequestStart, {
-            "method": job.method,
-            "absolute_url": abs_url,
-            "header": hdr,
-        })
-        # Send body if any
-        if job.body:
-            # Chunk transfer to server side
-            off = 0
-            while off < len(job.body):
-                chunk = job.body[off: off + 32 * 1024]
-                proto.write_frame(self.link.w, proto.TypeRequestBodyChunk, chunk)
-                off += len(chunk)
-        proto.write_frame(self.link.w, proto.TypeRequestEnd, b"")
-
-        # Read response start
-        t, payload = proto.read_frame(self.link.r)
-        if t != proto.TypeResponseStart:
-            self.link.reset()
-            raise RuntimeError(f"unexpected frame waiting response start: {t}")
-        rs = proto.decode_json(payload)
-        status_code = int(rs["status_code"]) if isinstance(rs.get("status_code"), int) else int(rs.get("status_code"))
-        headers = rs.get("header", {})
-
-        # Write response headers
-        job.handler.send_response(status_code)
-        for k, vv in headers.items():
-            for v in vv:
-                job.handler.send_header(k, v)
-        job.handler.end_headers()
-        # Stream body frames
+        proto.write_frame(w, proto.TypeRequestStart, proto.encode_request_start(job.method, abs_url, hdr))
+        # Forward the body as the handler thread queues it. A body cut short
+        # only aborts this request; the server answers it with a 502.
         while True:
-            t, payload = proto.read_frame(self.link.r)
-            if t == proto.TypeResponseBodyChunk:
-                if payload:
-                    job.handler.wfile.write(payload)
-                    job.handler.wfile.flush()
-            elif t == proto.TypeResponseEnd:
+            try:
+                chunk = job.body.get(timeout=BODY_STALL)
+            except queue.Empty:
+                log.warning("Upload to %s stalled, aborting it", abs_url)
+                job.body_abandoned = True
+                chunk = _BodyAborted
+            if chunk is None:
+                proto.write_frame(w, proto.TypeRequestEnd, b"")
                 break
-            else:
-                self.link.reset()
-                raise RuntimeError(f"unexpected frame in response: {t}")
+            if chunk is _BodyAborted:
+                proto.write_frame(w, proto.TypeRequestAbort, b"")
+                break
+            proto.write_frame(w, proto.TypeRequestBodyChunk, chunk)  # type: ignore[arg-type]
+        w.flush()
+
+    def _process_heartbeat(self, job: HeartbeatJob):
+        w = self.link.w
+        assert w
+        proto.write_frame(w, proto.TypeHeartbeat, b"")
+        w.flush()
+
+    def respond(self, job: RequestJob) -> Optional[Exception]:
+        # Runs on the browser's handler thread, writing out the frames the
+        # link reader routes to this job.
+        started = False
+        try:
+            t, payload = job.next_frame()
+            if t == _JobFailed:
+                return job.error
+            status_code, _, headers = proto.decode_response_start(payload)
+
+            # Write response headers
+            started = True
+            job.handler.send_response(status_code)
+            for k, vv in headers.items():
+                for v in vv:
+                    job.handler.send_header(k, v)
+            job.handler.end_headers()
+            wfile = job.handler.wfile
+            if job.frames.empty():
+                wfile.flush()
+            # Stream body frames. wfile is buffered, so bulk chunks coalesce;
+            # flush only for small frames or when nothing else is queued.
+            while True:
+                t, payload = job.next_frame()
+                if t == proto.TypeResponseBodyChunk:
+                    if payload:
+                        wfile.write(payload)
+                        if len(payload) < SMALL_FLUSH or job.frames.empty():
+                            wfile.flush()
+                elif t == proto.TypeResponseEnd:
+                    wfile.flush()
+                    return None
+                else:
+                    raise job.error or RuntimeError("link failed mid-response")
+        except Exception as e:
+            if not started:
+                return e
+            # Headers are out; dropping the connection is the only signal left
+            job.handler.close_connection = True
+            return None
+        finally:
+            job.drain()
 
     def _process_connect(self, job: ConnectJob):
-        print(f"[CLIENT] CONNECT to {job.hostport}")
+        log.debug("CONNECT to %s", job.hostport)
         self.link.ensure()
         assert self.link.r and self.link.w
 
@@ -194,19 +478,20 @@ class ProxyApp:
         if ':' not in hostport:
             hostport = f"{hostport}:443"  # Default HTTPS port
         
-        print(f"[CLIENT] Asking offshore to connect to {hostport}")
+        log.debug("Asking offshore to connect to %s", hostport)
         # Ask server to open connection
         proto.write_json_frame(self.link.w, proto.TypeConnectOpen, {"host": hostport})
+        self.link.w.flush()
         t, payload = proto.read_frame(self.link.r)
         if t != proto.TypeConnectOpenResult:
             self.link.reset()
             raise RuntimeError(f"unexpected frame waiting open result: {t}")
         res = proto.decode_json(payload)
         if not res.get("ok"):
-            print(f"[CLIENT] Offshore connect failed: {res.get('error')}")
+            log.warning("Offshore connect to %s failed: %s", hostport, res.get("error"))
             raise RuntimeError(f"offshore connect failed: {res.get('error')}")
         
-        print(f"[CLIENT] Offshore connected successfully to {hostport}")
+        log.debug("Offshore connected successfully to %s", hostport)
 
         # Send 200 Connection Established to the browser and hijack raw socket
         client_sock = job.handler.connection  # type: ignore[attr-defined]
@@ -237,14 +522,10 @@ class ProxyApp:
         th.start()
 
         try:
-            while True:
-                data = client_sock.recv(32 * 1024)
-                if data:
-                    proto.write_frame(self.link.w, proto.TypeConnectDataC2S, data)
-                else:
-                    # client closed
-                    proto.write_frame(self.link.w, proto.TypeConnectClose, b"")
-                    break
+            proto.relay_frames(client_sock, self.link.sock, self.link.w, proto.TypeConnectDataC2S)
+            # client closed
+            proto.write_frame(self.link.w, proto.TypeConnectClose, b"")
+            self.link.w.flush()
         finally:
             # Wait for server to signal close
             done_s2c.wait(timeout=10)
@@ -255,6 +536,16 @@ class ProxyApp:
 class ProxyHandler(BaseHTTPRequestHandler):
     server_version = "ShipProxy/py"
     protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+    # Buffer writes to the browser; respond() decides when to flush
+    wbufsize = proto.CHUNK
+
+    def handle_expect_100(self):
+        # The interim response only reaches the buffer; the browser holds
+        # the body back until it sees it
+        ok = super().handle_expect_100()
+        self.wfile.flush()
+        return ok
 
     def do_CONNECT(self):
         app: ProxyApp = self.server.app  # type: ignore[attr-defined]
@@ -270,8 +561,8 @@ class ProxyHandler(BaseHTTPRequestHandler):
     def do_ANY(self):
         app: ProxyApp = self.server.app  # type: ignore[attr-defined]
         job = RequestJob(self)
-        app.enqueue(job)
-        err = job.wait()
+        app.submit(job)
+        err = app.respond(job)
         if err:
             self.send_error(502, f"Proxy error: {err}")
 
@@ -283,12 +574,19 @@ class ProxyHandler(BaseHTTPRequestHandler):
     def do_OPTIONS(self): self.do_ANY()
     def do_PATCH(self): self.do_ANY()
 
-    # Enable logging to see what's happening
+    # Access log; formatting is skipped entirely when INFO is disabled
     def log_message(self, fmt, *args):
-        print(f"[CLIENT] {fmt % args}")
+        if log.isEnabledFor(logging.INFO):
+            log.info(fmt, *args)
 
 
 class ProxyHTTPServer(ThreadingHTTPServer):
+    # Still one handler thread per browser connection
+    # Browsers open bursts of connections; don't refuse them at accept
+    request_queue_size = 128
+    # Handler threads are daemons; skip tracking them for server_close()
+    block_on_close = False
+
     def __init__(self, server_address, RequestHandlerClass, app: ProxyApp):
         super().__init__(server_address, RequestHandlerClass)
         self.app = app
@@ -298,7 +596,9 @@ def main():
     parser = argparse.ArgumentParser(description="Ship proxy client (sequential over single TCP)")
     parser.add_argument("--listen", default=":8080", help="listen address, default :8080")
     parser.add_argument("--server", default="127.0.0.1:9090", help="offshore server host:port")
+    parser.add_argument("--log-level", default="info", help="debug, info, warning or error; default info")
     args = parser.parse_args()
+    logging.basicConfig(level=args.log_level.upper(), format="[CLIENT] %(message)s")
 
     if args.listen.startswith(":"):
         host = "0.0.0.0"
@@ -312,7 +612,7 @@ def main():
 
     app = ProxyApp((srv_host, srv_port))
     httpd = ProxyHTTPServer((host, port), ProxyHandler, app)
-    print(f"Ship proxy listening on {host}:{port}, offshore={srv_host}:{srv_port}")
+    log.info("Ship proxy listening on %s:%d, offshore=%s:%d", host, port, srv_host, srv_port)
     httpd.serve_forever()
 
 
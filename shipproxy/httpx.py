@@ -1,7 +1,8 @@
-from typing import Dict, List
+import io
+from typing import Dict, Iterator, List
 
 # Hop-by-hop headers per RFC 7230 section 6.1
-HOP_BY_HOP = {
+HOP_BY_HOP = frozenset({
     "connection",
     "proxy-connection",
     "keep-alive",
@@ -11,12 +12,38 @@ HOP_BY_HOP = {
     "trailer",
     "transfer-encoding",
     "upgrade",
-}
+})
 
 
 def copy_headers(dst: Dict[str, List[str]], src: Dict[str, List[str]]):
+    hop = HOP_BY_HOP
+    dst_get = dst.get
     for k, vv in src.items():
-        if k.lower() in HOP_BY_HOP:
+        if k.lower() in hop:
             continue
-        for v in vv:
-            dst.setdefault(k, []).append(v)
+        vals = dst_get(k)
+        if vals is None:
+            dst[k] = list(vv)
+        else:
+            vals.extend(vv)
+
+
+def iter_chunked(rfile: io.BufferedIOBase, size: int) -> Iterator[bytes]:
+    # Decode a Transfer-Encoding: chunked body, yielding at most size bytes
+    # at a time and consuming the trailer section.
+    while True:
+        line = rfile.readline(65537)
+        if not line:
+            raise EOFError("unexpected EOF in chunked body")
+        n = int(line.split(b";", 1)[0].strip(), 16)
+        if n == 0:
+            while rfile.readline(65537) not in (b"\r\n", b"\n", b""):
+                pass
+            return
+        while n:
+            data = rfile.read(min(n, size))
+            if not data:
+                raise EOFError("unexpected EOF in chunked body")
+            n -= len(data)
+            yield data
+        rfile.readline(3)
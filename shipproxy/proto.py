@@ -1,12 +1,24 @@
+import collections
 import io
 import json
+import os
+import socket
 import struct
-from typing import Tuple, Optional
+import sys
+from typing import Dict, List, Optional, Tuple
+
+try:
+    import orjson
+except ImportError:  # optional; falls back to the stdlib codec
+    orjson = None
 
 # Frame types
 TypeRequestStart = 1
 TypeRequestBodyChunk = 2
 TypeRequestEnd = 3
+# Ends a request whose body the browser never finished sending; the server
+# drops the request and answers 502 so responses stay in order
+TypeRequestAbort = 7
 
 TypeResponseStart = 4
 TypeResponseBodyChunk = 5
@@ -18,45 +30,279 @@ TypeConnectDataC2S = 12
 TypeConnectDataS2C = 13
 TypeConnectClose = 14
 
+# Sent by the client on an idle link; the server echoes it back
+TypeHeartbeat = 99
+
+# First byte of a TypeRequestStart/TypeResponseStart payload. Binary starts
+# carry length-prefixed fields; anything else is the original JSON object
+# (optionally behind a StartCodecJSON byte).
+StartCodecJSON = 0
+StartCodecBinary = 1
+
+# Transfer unit for HTTP body frames; CONNECT tunnels carry bulk TLS and
+# read in larger units.
+CHUNK = 64 * 1024
+TUNNEL_CHUNK = 128 * 1024
+# Upper bound for a response body frame
+FRAME_CAP = 256 * 1024
+
+# Userspace buffer for the link's BufferedReader/BufferedWriter, sized to
+# hold whole body frames; on the write side frames accumulate here between
+# explicit flushes.
+LINK_BUF = 256 * 1024
+
+# Kernel send/receive buffer size for the link and tunnel sockets
+SOCK_BUF = 2 * 1024 * 1024
+
+
+# Free list of receive buffers for the relay_frames fallback, used where
+# os.splice is unavailable (spliced tunnels need no userspace buffer). A new
+# tunnel reuses a buffer instead of allocating one. deque append/pop are
+# atomic, so no lock is needed; a full pool drops the extra buffer.
+BUFFER_POOL = 32
+_buffers: "collections.deque[bytearray]" = collections.deque(maxlen=BUFFER_POOL)
+
+
+def take_buffer() -> bytearray:
+    try:
+        return _buffers.pop()
+    except IndexError:
+        return bytearray(TUNNEL_CHUNK)
+
+
+def give_buffer(buf: bytearray) -> None:
+    _buffers.append(buf)
+
+
+# On Linux, tunnel bytes can move socket -> pipe -> socket with os.splice and
+# never enter userspace. Only the sending side of a hop qualifies: the link's
+# receive side goes through a BufferedReader that may already hold data.
+CAN_SPLICE = sys.platform == "linux" and hasattr(os, "splice")
+
+
+def relay_frames(src: socket.socket, dst: socket.socket, w: io.BufferedWriter, t: int) -> None:
+    # Forward everything src sends as type-t frames on the link until src
+    # reaches EOF. dst is the link socket under w; w must be flushed and no
+    # other thread may write to the link meanwhile.
+    if CAN_SPLICE:
+        _relay_spliced(src, dst, t)
+        return
+    # Otherwise each frame goes straight to the socket with one vectored
+    # sendmsg (header + payload view), skipping the copy into w's buffer.
+    # Platforms without sendmsg (Windows) go through w.
+    vectored = hasattr(dst, "sendmsg")
+    buf = take_buffer()
+    try:
+        with memoryview(buf) as mv:
+            while True:
+                n = src.recv_into(buf)
+                if not n:
+                    return
+                if vectored:
+                    _sendmsg_all(dst, [struct.pack("!BI", t, n), mv[:n]])
+                else:
+                    write_frame(w, t, mv[:n])
+                    w.flush()
+    finally:
+        give_buffer(buf)
+
+
+def _sendmsg_all(sock: socket.socket, bufs: list) -> None:
+    while True:
+        sent = sock.sendmsg(bufs)
+        while bufs and sent >= len(bufs[0]):
+            sent -= len(bufs[0])
+            bufs.pop(0)
+        if not bufs:
+            return
+        bufs[0] = memoryview(bufs[0])[sent:]
+
+
+def _relay_spliced(src: socket.socket, dst: socket.socket, t: int) -> None:
+    rfd, wfd = os.pipe()
+    try:
+        try:
+            import fcntl
+            fcntl.fcntl(wfd, fcntl.F_SETPIPE_SZ, TUNNEL_CHUNK)
+        except (ImportError, AttributeError, OSError):
+            pass  # default 64 KB pipe; splice just moves less per frame
+        src_fd = src.fileno()
+        dst_fd = dst.fileno()
+        while True:
+            n = os.splice(src_fd, wfd, TUNNEL_CHUNK, flags=os.SPLICE_F_MOVE)
+            if not n:
+                return
+            # MSG_MORE corks the header so it leaves with the spliced payload
+            dst.sendall(struct.pack("!BI", t, n), socket.MSG_MORE)
+            while n:
+                n -= os.splice(rfd, dst_fd, n, flags=os.SPLICE_F_MOVE)
+    finally:
+        os.close(rfd)
+        os.close(wfd)
+
+
+def enable_keepalive(sock: socket.socket) -> None:
+    # SO_KEEPALIVE alone waits about two hours before the first probe on
+    # Linux; probe after 30 s idle and give up after three missed probes.
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+    if hasattr(socket, "TCP_KEEPIDLE"):
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, 30)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, 10)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPCNT, 3)
+
+
+def tune_socket(sock: socket.socket) -> None:
+    # Nagle off: frames are already batched in the BufferedWriter and flushed
+    # deliberately, so a flushed control frame should leave immediately.
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, SOCK_BUF)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, SOCK_BUF)
+
 
 def write_frame(w: io.BufferedWriter, t: int, payload: Optional[bytes]) -> None:
+    # payload may be any bytes-like object, including a memoryview over a
+    # reused receive buffer; it is handed to the writer as-is rather than
+    # concatenated onto the header. The writer is not flushed here; callers
+    # flush at logical boundaries (end of request/response, tunnel data) so
+    # body frames can batch in the buffer.
     if payload is None:
         payload = b""
-    w.write(bytes([t]))
-    w.write(struct.pack("!I", len(payload)))
+    w.write(struct.pack("!BI", t, len(payload)))
     if payload:
         w.write(payload)
-    w.flush()
 
 
 def _read_exact(r: io.BufferedReader, n: int) -> bytes:
-    buf = b""
-    while len(buf) < n:
-        chunk = r.read(n - len(buf))
-        if not chunk:
+    # BufferedReader.read(n) only comes back short at EOF, so the common case
+    # is a single call. Otherwise fill a preallocated buffer in place rather
+    # than growing a bytes object by concatenation.
+    data = r.read(n)
+    if data is not None and len(data) == n:
+        return data
+    buf = bytearray(n)
+    off = len(data) if data else 0
+    buf[:off] = data or b""
+    mv = memoryview(buf)
+    while off < n:
+        k = r.readinto(mv[off:])
+        if not k:
             raise EOFError("unexpected EOF while reading frame")
-        buf += chunk
-    return buf
+        off += k
+    return bytes(buf)
 
 
 def read_frame(r: io.BufferedReader) -> Tuple[int, bytes]:
-    t_b = _read_exact(r, 1)
-    t = t_b[0]
-    ln_b = _read_exact(r, 4)
-    (ln,) = struct.unpack("!I", ln_b)
+    t, ln = struct.unpack("!BI", _read_exact(r, 5))
     payload = b""
     if ln:
         payload = _read_exact(r, ln)
     return t, payload
 
 
-def encode_json(v) -> bytes:
-    return json.dumps(v, separators=(",", ":")).encode("utf-8")
-
+if orjson is not None:
+    # orjson works on bytes directly and emits compact output
+    encode_json = orjson.dumps
+    decode_json = orjson.loads
+else:
+    def encode_json(v) -> bytes:
+        return json.dumps(v, separators=(",", ":")).encode("utf-8")
 
-def decode_json(data: bytes):
-    return json.loads(data.decode("utf-8"))
+    def decode_json(data: bytes):
+        return json.loads(data.decode("utf-8"))
 
 
 def write_json_frame(w: io.BufferedWriter, t: int, v) -> None:
     write_frame(w, t, encode_json(v))
+
+
+# Binary start frames. Header names and values travel as their HTTP octets
+# (latin-1), so they round-trip exactly without escaping.
+#
+#   request:  codec u8 | method_len u16 | method | url_len u32 | url | headers
+#   response: codec u8 | status_code u16 | reason_len u16 | reason | headers
+#   headers:  count u16 | (name_len u16 | name | value_len u32 | value) * count
+
+def _encode_start(prefix: bytes, headers: Dict[str, List[str]]) -> bytes:
+    pairs = [(k.encode("latin-1"), v.encode("latin-1")) for k, vv in headers.items() for v in vv]
+    size = len(prefix) + 2 + sum(6 + len(k) + len(v) for k, v in pairs)
+    buf = bytearray(size)
+    off = len(prefix)
+    buf[:off] = prefix
+    struct.pack_into("!H", buf, off, len(pairs))
+    off += 2
+    for k, v in pairs:
+        struct.pack_into("!H", buf, off, len(k))
+        off += 2
+        buf[off:off + len(k)] = k
+        off += len(k)
+        struct.pack_into("!I", buf, off, len(v))
+        off += 4
+        buf[off:off + len(v)] = v
+        off += len(v)
+    return bytes(buf)
+
+
+def _decode_headers(data: bytes, off: int) -> Dict[str, List[str]]:
+    hdr: Dict[str, List[str]] = {}
+    (count,) = struct.unpack_from("!H", data, off)
+    off += 2
+    for _ in range(count):
+        (ln,) = struct.unpack_from("!H", data, off)
+        off += 2
+        k = data[off:off + ln].decode("latin-1")
+        off += ln
+        (ln,) = struct.unpack_from("!I", data, off)
+        off += 4
+        v = data[off:off + ln].decode("latin-1")
+        off += ln
+        vals = hdr.get(k)
+        if vals is None:
+            hdr[k] = [v]
+        else:
+            vals.append(v)
+    return hdr
+
+
+def _decode_json_start(payload: bytes):
+    if payload[:1] == bytes([StartCodecJSON]):
+        payload = payload[1:]
+    return decode_json(payload)
+
+
+def encode_request_start(method: str, url: str, headers: Dict[str, List[str]]) -> bytes:
+    m = method.encode("latin-1")
+    u = url.encode("latin-1")
+    prefix = struct.pack(f"!BH{len(m)}sI", StartCodecBinary, len(m), m, len(u)) + u
+    return _encode_start(prefix, headers)
+
+
+def decode_request_start(payload: bytes) -> Tuple[str, str, Dict[str, List[str]]]:
+    if payload[:1] != bytes([StartCodecBinary]):
+        rs = _decode_json_start(payload)
+        return rs.get("method", "GET"), rs.get("absolute_url"), rs.get("header", {})
+    (ln,) = struct.unpack_from("!H", payload, 1)
+    off = 3
+    method = payload[off:off + ln].decode("latin-1")
+    off += ln
+    (ln,) = struct.unpack_from("!I", payload, off)
+    off += 4
+    url = payload[off:off + ln].decode("latin-1")
+    off += ln
+    return method, url, _decode_headers(payload, off)
+
+
+def encode_response_start(status_code: int, reason: str, headers: Dict[str, List[str]]) -> bytes:
+    rb = reason.encode("latin-1")
+    prefix = struct.pack(f"!BHH{len(rb)}s", StartCodecBinary, status_code, len(rb), rb)
+    return _encode_start(prefix, headers)
+
+
+def decode_response_start(payload: bytes) -> Tuple[int, str, Dict[str, List[str]]]:
+    if payload[:1] != bytes([StartCodecBinary]):
+        rs = _decode_json_start(payload)
+        return int(rs.get("status_code")), rs.get("status", ""), rs.get("header", {})
+    status_code, ln = struct.unpack_from("!HH", payload, 1)
+    off = 5
+    reason = payload[off:off + ln].decode("latin-1")
+    off += ln
+    return status_code, reason, _decode_headers(payload, off)
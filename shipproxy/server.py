@@ -1,5 +1,6 @@
 import argparse
 import io
+import logging
 import socket
 import threading
 import time
@@ -10,6 +11,8 @@ import requests
 from . import proto
 from .httpx import copy_headers, HOP_BY_HOP
 
+log = logging.getLogger(__name__)
+
 # Use a single Requests session. Disable env proxies to avoid accidental
 # re-proxying, and set a simple User-Agent for friendlier upstreams.
 session = requests.Session()
@@ -22,6 +25,13 @@ session.headers.update({
     ),
     "Accept-Language": "en-US,en;q=0.9",
 })
+# urllib3 keeps only 10 host pools with 10 connections each by default.
+# Cache more origins so a browsing session keeps reusing warm (already
+# TLS-handshaken) upstream connections instead of re-dialing them, and
+# allow a few concurrent ship links to share one origin.
+_adapter = requests.adapters.HTTPAdapter(pool_connections=256, pool_maxsize=32)
+session.mount("http://", _adapter)
+session.mount("https://", _adapter)
 
 
 class OffshoreServer:
@@ -34,37 +44,52 @@ class OffshoreServer:
             s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
             s.bind((self.listen_host, self.listen_port))
             s.listen(1)
-            print(f"Offshore proxy server listening on {self.listen_host}:{self.listen_port}")
+            log.info("Offshore proxy server listening on %s:%d", self.listen_host, self.listen_port)
             while True:
                 conn, addr = s.accept()
-                print(f"Client connected from {addr}")
+                proto.enable_keepalive(conn)
+                proto.tune_socket(conn)
+                log.info("Client connected from %s", addr)
                 t = threading.Thread(target=self.handle_client, args=(conn,), daemon=True)
                 t.start()
 
     def handle_client(self, sock: socket.socket):
         with sock:
-            r = sock.makefile('rb')
-            w = sock.makefile('wb')
+            r = sock.makefile('rb', buffering=proto.LINK_BUF)
+            w = sock.makefile('wb', buffering=proto.LINK_BUF)
             try:
                 while True:
                     t, payload = proto.read_frame(r)
                     if t == proto.TypeRequestStart:
                         self.handle_http(r, w, payload)
                     elif t == proto.TypeConnectOpen:
-                        self.handle_connect(r, w, payload)
+                        self.handle_connect(sock, r, w, payload)
+                    elif t == proto.TypeHeartbeat:
+                        proto.write_frame(w, proto.TypeHeartbeat, b'')
+                        w.flush()
                     else:
                         raise RuntimeError(f"unexpected frame type: {t}")
             except EOFError:
                 return
             except Exception as e:
-                print(f"[SERVER] error: {e}")
+                log.error("error: %s", e)
                 return
+            finally:
+                # `with sock` leaves the fd open while the file objects still
+                # reference it. Shut the link down so the client always sees
+                # EOF rather than waiting on a reader that has given up.
+                try:
+                    sock.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+                for f in (r, w):
+                    try:
+                        f.close()
+                    except (OSError, ValueError):
+                        pass
 
     def handle_http(self, r: io.BufferedReader, w: io.BufferedWriter, start_payload: bytes):
-        rs = proto.decode_json(start_payload)
-        method: str = rs.get('method', 'GET')
-        absolute_url: str = rs.get('absolute_url')
-        headers_in: Dict[str, List[str]] = rs.get('header', {})
+        method, absolute_url, headers_in = proto.decode_request_start(start_payload)
 
         # Build outgoing headers (exclude hop-by-hop)
         out_headers: Dict[str, str] = {}
@@ -87,8 +112,10 @@ class OffshoreServer:
                 content_length = None
 
         MAX_BUFFER = 10 * 1024 * 1024  # 10 MB safety cap
+        body_done = False
 
         def read_body_frames_to_end() -> bytes:
+            nonlocal body_done
             buf = bytearray()
             while True:
                 t, payload = proto.read_frame(r)
@@ -97,22 +124,40 @@ class OffshoreServer:
                         buf.extend(payload)
                         # Keep reading until RequestEnd to maintain framing alignment
                 elif t == proto.TypeRequestEnd:
+                    body_done = True
                     return bytes(buf)
+                elif t == proto.TypeRequestAbort:
+                    body_done = True
+                    raise RuntimeError("client aborted the request body")
                 else:
                     raise RuntimeError(f"unexpected frame in request body: {t}")
 
         # Streaming request body generator (used if no/large Content-Length)
         def body_iter():
+            nonlocal body_done
             while True:
                 t, payload = proto.read_frame(r)
                 if t == proto.TypeRequestBodyChunk:
                     if payload:
                         yield payload
                 elif t == proto.TypeRequestEnd:
+                    body_done = True
                     return
+                elif t == proto.TypeRequestAbort:
+                    body_done = True
+                    raise RuntimeError("client aborted the request body")
                 else:
                     raise RuntimeError(f"unexpected frame in request body: {t}")
 
+        def skip_body_frames() -> None:
+            # An aborted body ends the request just like RequestEnd here
+            while True:
+                t, _ = proto.read_frame(r)
+                if t in (proto.TypeRequestEnd, proto.TypeRequestAbort):
+                    return
+                if t != proto.TypeRequestBodyChunk:
+                    raise RuntimeError(f"unexpected frame in request body: {t}")
+
         try:
             # Make request upstream
             if content_length is not None and content_length <= MAX_BUFFER:
@@ -137,75 +182,89 @@ class OffshoreServer:
                     timeout=30,
                 )
         except Exception as e:
+            # The client streams the body behind the start frame and may have
+            # pipelined the next request after it; skip what upstream never
+            # consumed so the link stays aligned.
+            if not body_done:
+                skip_body_frames()
             # Send 502 response back
-            proto.write_json_frame(w, proto.TypeResponseStart, {
-                'status_code': 502,
-                'status': 'Bad Gateway',
-                'header': {'Content-Type': ['text/plain']},
-            })
+            proto.write_frame(w, proto.TypeResponseStart, proto.encode_response_start(
+                502, 'Bad Gateway', {'Content-Type': ['text/plain']}))
             proto.write_frame(w, proto.TypeResponseBodyChunk, f"Bad Gateway: {e}".encode('utf-8'))
             proto.write_frame(w, proto.TypeResponseEnd, b'')
+            w.flush()
             return
 
         try:
             # Prepare response headers excluding hop-by-hop
             res_hdr_dict: Dict[str, List[str]] = {}
+            hop = HOP_BY_HOP
             for k, v in resp.headers.items():
-                if k.lower() in HOP_BY_HOP:
+                if k.lower() in hop:
                     continue
-                res_hdr_dict.setdefault(k, []).append(v)
+                # requests folds repeated headers, so each name appears once
+                res_hdr_dict[k] = [v]
 
-            proto.write_json_frame(w, proto.TypeResponseStart, {
-                'status_code': int(resp.status_code),
-                'status': resp.reason or '',
-                'header': res_hdr_dict,
-            })
+            proto.write_frame(w, proto.TypeResponseStart, proto.encode_response_start(
+                int(resp.status_code), resp.reason or '', res_hdr_dict))
+            # Let the client emit headers before the body starts arriving
+            w.flush()
 
-            for chunk in resp.iter_content(chunk_size=32 * 1024):
-                if chunk:
-                    proto.write_frame(w, proto.TypeResponseBodyChunk, chunk)
+            # Frame whatever upstream has ready, up to FRAME_CAP at a time.
+            # read1 returns as soon as any data arrives (unlike read, which
+            # waits to fill the whole amount), and a short read means
+            # upstream has nothing more for now, so push it onto the link.
+            read1 = resp.raw.read1
+            while True:
+                chunk = read1(proto.FRAME_CAP, decode_content=True)
+                if not chunk:
+                    break
+                proto.write_frame(w, proto.TypeResponseBodyChunk, chunk)
+                if len(chunk) < proto.FRAME_CAP:
+                    w.flush()
             proto.write_frame(w, proto.TypeResponseEnd, b'')
+            w.flush()
         finally:
             try:
                 resp.close()
             except Exception:
                 pass
 
-    def handle_connect(self, r: io.BufferedReader, w: io.BufferedWriter, payload: bytes):
+    def handle_connect(self, sock: socket.socket, r: io.BufferedReader, w: io.BufferedWriter, payload: bytes):
         obj = proto.decode_json(payload)
         host = obj.get('host')
-        print(f"[SERVER] CONNECT request to {host}")
+        log.debug("CONNECT request to %s", host)
         try:
             if ':' in host:
                 h, ps = host.split(':', 1)
-                print(f"[SERVER] Connecting to {h}:{ps}")
                 remote = socket.create_connection((h, int(ps)), timeout=15)
             else:
-                print(f"[SERVER] Connecting to {host}:443")
                 remote = socket.create_connection((host, 443), timeout=15)
-            print(f"[SERVER] Successfully connected to {host}")
+            # Idle tunnels stay open; the timeout only bounds connecting
+            remote.settimeout(None)
+            proto.tune_socket(remote)
+            log.debug("Successfully connected to %s", host)
         except Exception as e:
-            print(f"[SERVER] Failed to connect to {host}: {e}")
+            log.warning("Failed to connect to %s: %s", host, e)
             proto.write_json_frame(w, proto.TypeConnectOpenResult, {'ok': False, 'error': str(e)})
+            w.flush()
             return
 
         proto.write_json_frame(w, proto.TypeConnectOpenResult, {'ok': True})
+        w.flush()
 
         # Start S2C reader thread
         done_s2c = threading.Event()
         def s2c():
             try:
-                while True:
-                    data = remote.recv(32 * 1024)
-                    if data:
-                        proto.write_frame(w, proto.TypeConnectDataS2C, data)
-                    else:
-                        proto.write_frame(w, proto.TypeConnectClose, b'')
-                        done_s2c.set()
-                        return
+                proto.relay_frames(remote, sock, w, proto.TypeConnectDataS2C)
+                proto.write_frame(w, proto.TypeConnectClose, b'')
+                w.flush()
+                done_s2c.set()
             except Exception:
                 try:
                     proto.write_frame(w, proto.TypeConnectClose, b'')
+                    w.flush()
                 except Exception:
                     pass
                 done_s2c.set()
@@ -227,6 +286,14 @@ class OffshoreServer:
                     raise RuntimeError(f"unexpected frame in CONNECT: {t}")
         finally:
             done_s2c.wait(timeout=10)
+            # The S2C relay may splice from remote's raw fd number. Wake it
+            # and let it finish before closing, or a socket opened later
+            # could reuse the fd and have its bytes relayed onto the link.
+            try:
+                remote.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            th.join()
             try:
                 remote.close()
             except Exception:
@@ -236,7 +303,9 @@ class OffshoreServer:
 def main():
     p = argparse.ArgumentParser(description='Offshore proxy server')
     p.add_argument('--listen', default=':9090', help='listen address, default :9090')
+    p.add_argument('--log-level', default='info', help='debug, info, warning or error; default info')
     args = p.parse_args()
+    logging.basicConfig(level=args.log_level.upper(), format='[SERVER] %(message)s')
 
     if args.listen.startswith(':'):
         host = '0.0.0.0'